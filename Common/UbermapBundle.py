@@ -0,0 +1,159 @@
+# Ubermap device config bundle
+# Packs every config in the Devices folder into a single indexed file, which is memory mapped at runtime so
+# only the records that are actually needed get read and decoded. Build it with:
+#   python -m Ubermap.UbermapBundle [devices folder] [bundle file]
+#
+# Layout (little endian):
+#   header: magic, format version, record count
+#   index:  for each record, name length, source mtime, source size, record offset, record length, name (UTF-8)
+#   records: config_to_data() output of each config, as UTF-8 JSON
+
+from Ubermap.UbermapConfigParser import parse_config, config_to_data
+from Ubermap import six
+import glob
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+
+PY2 = sys.version_info[0] == 2
+
+BUNDLE_MAGIC = b'UBMB'
+BUNDLE_VERSION = 1
+BUNDLE_HEADER = struct.Struct('<4sII')
+BUNDLE_INDEX_ENTRY = struct.Struct('<HdQQI')
+
+
+def build_bundle(devices_folder, bundle_path):
+    """Write a bundle of all parseable configs in devices_folder to bundle_path, returning the number of configs
+    bundled and a list of (path, error) for the configs that were skipped. The mtime and size of each config are
+    stored with it, so an edited config is read from its file again instead of the bundle."""
+    names = []
+    records = []
+    skipped = []
+    for path in sorted(glob.glob(os.path.join(devices_folder, '*.cfg'))):
+        st = os.stat(path)
+        try:
+            data = config_to_data(parse_config(path))
+        except Exception as e:
+            skipped.append((path, e))
+            continue
+
+        names.append((os.path.basename(path)[:-len('.cfg')].encode('utf-8'), st.st_mtime, st.st_size))
+        records.append(json.dumps(data, separators=(',', ':')).encode('utf-8'))
+
+    index_size = sum(BUNDLE_INDEX_ENTRY.size + len(name) for name, _, _ in names)
+    offset = BUNDLE_HEADER.size + index_size
+
+    tmp_path = bundle_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(BUNDLE_HEADER.pack(BUNDLE_MAGIC, BUNDLE_VERSION, len(names)))
+        for (name, mtime, size), record in zip(names, records):
+            f.write(BUNDLE_INDEX_ENTRY.pack(len(name), mtime, size, offset, len(record)))
+            f.write(name)
+            offset += len(record)
+        for record in records:
+            f.write(record)
+
+    if os.path.exists(bundle_path):
+        os.remove(bundle_path)
+    os.rename(tmp_path, bundle_path)
+    return len(names), skipped
+
+
+def _to_native(data):
+    # json gives unicode strings on Python 2, where ConfigObj values are byte strings
+    if isinstance(data, list):
+        return [_to_native(v) for v in data]
+    if isinstance(data, six.text_type):
+        return data.encode('utf-8')
+    return data
+
+
+class UbermapBundle:
+    """Read side of a bundle file. The file is reopened when it changes on disk, checked at most once per
+    check_interval seconds. Safe to use from several threads."""
+
+    def __init__(self, path, check_interval = 1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self._checked = None
+        self._stat = None
+        self._file = None
+        self._map = None
+        self._index = {}
+        self._lock = threading.Lock()
+
+    def get(self, name, mtime, size):
+        """Returns the config_to_data() output for config name, if the bundle has it for this mtime and size."""
+        with self._lock:
+            self._refresh()
+
+            record = self._index.get(name)
+            if record is None or record[0] != mtime or record[1] != size:
+                return None
+
+            offset, length = record[2], record[3]
+            data = json.loads(self._map[offset:offset + length].decode('utf-8'))
+
+        return _to_native(data) if PY2 else data
+
+    def _refresh(self):
+        now = time.time()
+        if self._checked is not None and now - self._checked < self.check_interval:
+            return
+        self._checked = now
+
+        try:
+            st = os.stat(self.path)
+            st = (st.st_mtime, st.st_size)
+        except OSError:
+            st = None
+
+        if st != self._stat:
+            self._close()
+            self._stat = st
+            if st is not None:
+                self._open()
+
+    def _open(self):
+        try:
+            self._file = open(self.path, 'rb')
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, count = BUNDLE_HEADER.unpack_from(self._map, 0)
+            if magic != BUNDLE_MAGIC or version != BUNDLE_VERSION:
+                raise ValueError('unsupported bundle format')
+
+            offset = BUNDLE_HEADER.size
+            for _ in range(count):
+                name_length, mtime, size, record_offset, record_length = BUNDLE_INDEX_ENTRY.unpack_from(self._map,
+                                                                                                        offset)
+                offset += BUNDLE_INDEX_ENTRY.size
+                name = self._map[offset:offset + name_length].decode('utf-8')
+                offset += name_length
+                self._index[name.encode('utf-8') if PY2 else name] = (mtime, size, record_offset, record_length)
+        except (IOError, OSError, ValueError, struct.error):
+            self._close()
+
+    def _close(self):
+        if self._map is not None:
+            self._map.close()
+        if self._file is not None:
+            self._file.close()
+        self._file = None
+        self._map = None
+        self._index = {}
+
+
+if __name__ == '__main__':
+    ubermap_root = os.path.join(os.path.expanduser("~"), 'Ubermap')
+    devices_folder = sys.argv[1] if len(sys.argv) > 1 else os.path.join(ubermap_root, 'Devices')
+    bundle_path = sys.argv[2] if len(sys.argv) > 2 else os.path.join(ubermap_root, 'Devices.bundle')
+
+    count, skipped = build_bundle(devices_folder, bundle_path)
+    for path, e in skipped:
+        print('skipping ' + path + ': ' + str(e))
+    print('bundled ' + str(count) + ' configs from ' + devices_folder + ' into ' + bundle_path)
@@ -0,0 +1,211 @@
+# Ubermap config parser
+# Single pass parser for the subset of the ConfigObj format used by Ubermap configs: nested [sections],
+# "key = value" lines with optionally quoted keys and single values, unquoted "key = value1, value2" lists,
+# and comments. Anything else (quoted list items, multiline values, BOMs, duplicate keys, nesting errors...)
+# makes it fall back to ConfigObj, which either handles it or raises the same error as before.
+
+from Ubermap.configobj import ConfigObj, BOMS
+import sys
+
+PY2 = sys.version_info[0] == 2
+
+QUOTES = ('"', "'")
+
+
+class UnsupportedSyntax(Exception):
+    pass
+
+
+def parse_config(path):
+    """Parse the config file at path, returning the same ConfigObj instance that ConfigObj(path) would."""
+    try:
+        with open(path, 'rb') as f:
+            content = f.read()
+        config = parse_config_content(content)
+    except (UnsupportedSyntax, UnicodeDecodeError):
+        return ConfigObj(path)
+
+    config.filename = path
+    return config
+
+
+def parse_config_content(content):
+    for bom in BOMS:
+        if content.startswith(bom):
+            raise UnsupportedSyntax('BOM')
+
+    if not PY2:
+        content = content.decode('utf-8')
+
+    config = ConfigObj()
+    # depth of each section is tracked by ConfigObj's Section.depth, starting with 0 for the file itself
+    section = config
+
+    for line in content.split('\n'):
+        line = line.strip()
+        if not line or line[0] == '#':
+            continue
+
+        if line[0] == '[':
+            depth, name = _parse_section_marker(line)
+            if depth > section.depth + 1:
+                raise UnsupportedSyntax('section too nested')
+
+            parent = section
+            while parent.depth >= depth:
+                parent = parent.parent
+
+            if name in parent:
+                raise UnsupportedSyntax('duplicate section')
+
+            parent[name] = {}
+            section = parent[name]
+            continue
+
+        key, value = _parse_key(line)
+        if key in section:
+            raise UnsupportedSyntax('duplicate key')
+
+        _add_scalar(section, key, _parse_value(value))
+
+    return config
+
+
+def _add_scalar(section, key, value):
+    # Equivalent to section[key] = value for a new scalar key, without Section.__setitem__'s type checks
+    section.scalars.append(key)
+    section.comments[key] = []
+    section.inline_comments[key] = ''
+    dict.__setitem__(section, key, value)
+
+
+def config_to_data(section):
+    """Convert a config to plain nested ([(key, value), ...], [(section name, section data), ...]) tuples, e.g.
+    for storing it on disk. Raw values are used so interpolation still happens lazily on the rebuilt config."""
+    return ([(k, dict.__getitem__(section, k)) for k in section.scalars],
+            [(k, config_to_data(section[k])) for k in section.sections])
+
+
+def data_to_config(data):
+    """Rebuild a ConfigObj from the output of config_to_data."""
+    def set_section(section, data):
+        scalars, sections = data
+        for k, v in scalars:
+            _add_scalar(section, k, v)
+        for k, section_data in sections:
+            section[k] = {}
+            set_section(section[k], section_data)
+
+    config = ConfigObj()
+    set_section(config, data)
+    return config
+
+
+def _parse_section_marker(line):
+    depth = 0
+    while line[depth] == '[':
+        depth += 1
+
+    name, close, comment = line[depth:].partition(']' * depth)
+    name = name.strip()
+    comment = comment.strip()
+    if not close or not name or name[0] in QUOTES or '[' in name or ']' in name or \
+            (comment and comment[0] != '#'):
+        raise UnsupportedSyntax('invalid section marker')
+
+    return depth, name
+
+
+def _parse_key(line):
+    if line[0] in QUOTES:
+        end = line.find(line[0], 1)
+        separator = line[end + 1:].lstrip()
+        if end < 0 or not separator.startswith('='):
+            raise UnsupportedSyntax('invalid quoted key')
+        return line[1:end], separator[1:]
+
+    key, separator, value = line.partition('=')
+    key = key.rstrip()
+    if not separator or not key:
+        raise UnsupportedSyntax('invalid key')
+
+    return key, value
+
+
+def _parse_value(value):
+    value = value.strip()
+    if value and value[0] in QUOTES:
+        # Only a single quoted value, optionally followed by a comment
+        end = value.find(value[0], 1)
+        rest = value[end + 1:].lstrip()
+        if end < 0 or (rest and rest[0] != '#'):
+            raise UnsupportedSyntax('quoted list or invalid quoted value')
+        return value[1:end]
+
+    # Everything from the first # on is a comment
+    value = value.partition('#')[0].rstrip()
+    if not value:
+        return ''
+
+    if value == ',':
+        return []
+
+    if ',' not in value:
+        return value
+
+    items = [item.strip() for item in value.split(',')]
+    # A trailing comma just marks the value as a list
+    if not items[-1]:
+        items.pop()
+
+    for item in items:
+        if not item or item[0] in QUOTES:
+            raise UnsupportedSyntax('quoted or empty list item')
+
+    return items
+
+
+if __name__ == '__main__':
+    # Compare the parser against ConfigObj for every config in the given folders, and measure throughput:
+    # python -m Ubermap.UbermapConfigParser ~/Ubermap/Devices
+    import glob
+    import os
+    import time
+
+    paths = [p for d in sys.argv[1:] for p in sorted(glob.glob(os.path.join(d, '*.cfg')))]
+    mismatches = 0
+    fast_path = 0
+
+    for path in paths:
+        try:
+            expected = config_to_data(ConfigObj(path))
+        except Exception as e:
+            expected = type(e)
+
+        try:
+            with open(path, 'rb') as f:
+                parse_config_content(f.read())
+            fast_path += 1
+        except (UnsupportedSyntax, UnicodeDecodeError):
+            pass
+
+        try:
+            actual = config_to_data(parse_config(path))
+        except Exception as e:
+            actual = type(e)
+
+        if actual != expected:
+            mismatches += 1
+            print('MISMATCH: ' + path)
+
+    print('%d configs, %d on the fast path, %d mismatches' % (len(paths), fast_path, mismatches))
+
+    for name, parse in (('ConfigObj', ConfigObj), ('parse_config', parse_config)):
+        start = time.time()
+        for path in paths:
+            try:
+                parse(path)
+            except Exception:
+                pass
+        elapsed = time.time() - start
+        print('%s: %.1f ms, %.0f configs/s' % (name, elapsed * 1000, len(paths) / elapsed if elapsed else 0))
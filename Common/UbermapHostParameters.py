@@ -0,0 +1,94 @@
+# Ubermap host parameter maps
+# Reads the .shhpmap files that some plugins (e.g. D16 LuSH-101) use to assign their parameters to the host
+# parameter slots Live sees, so device configs can address plugin parameters by slot instead of by the name Live
+# shows, which may be ambiguous or duplicated. Maps are read from ~/Ubermap/Plugin Parameter Configs.
+
+from xml.etree.ElementTree import iterparse
+import glob
+import os
+import threading
+import time
+
+HOST_PARAMETER_MAP_EXTENSION = '.shhpmap'
+
+
+def parse_host_parameter_map(path):
+    """Returns (map name, {plugin parameter name: host slot}) for the .shhpmap file at path. Where a plugin
+    parameter is assigned to several slots, the first one wins."""
+    name = None
+    slots = {}
+
+    # Streamed, as maps of big plugins can have thousands of assignments
+    for event, element in iterparse(path, events=('start', 'end')):
+        if event == 'start':
+            if element.tag == 'HostParametersMap':
+                name = element.get('name')
+            continue
+
+        if element.tag == 'assign':
+            plugin_parameter = element.get('pluginParam')
+            try:
+                slot = int(element.get('hostParam'))
+            except (TypeError, ValueError):
+                slot = None
+
+            if plugin_parameter is not None and slot is not None:
+                slots.setdefault(plugin_parameter, slot)
+            element.clear()
+
+    return name, slots
+
+
+class UbermapHostParameterMaps:
+    """Index of the host parameter maps in a folder by map name (or file name, if the map has none). The folder is
+    checked for changes at most once per check_interval seconds, and only changed files are parsed again."""
+
+    def __init__(self, folder, check_interval = 1.0):
+        self.folder = folder
+        self.check_interval = check_interval
+        self._checked = None
+        # path -> (version, map name, slots), version being the file's (mtime, size)
+        self._files = {}
+        # map name -> (version, slots)
+        self._maps = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        """Returns (version, {plugin parameter name: host slot}) for the map called name, or None. version changes
+        whenever the map's file does."""
+        with self._lock:
+            self._refresh()
+            return self._maps.get(name)
+
+    def _refresh(self):
+        now = time.time()
+        if self._checked is not None and now - self._checked < self.check_interval:
+            return
+        self._checked = now
+
+        files = {}
+        changed = False
+        for path in glob.glob(os.path.join(self.folder, '*' + HOST_PARAMETER_MAP_EXTENSION)):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+
+            version = (st.st_mtime, st.st_size)
+            known = self._files.get(path)
+            if known is not None and known[0] == version:
+                files[path] = known
+                continue
+
+            try:
+                name, slots = parse_host_parameter_map(path)
+            except (IOError, OSError, SyntaxError):
+                # ElementTree's ParseError is a SyntaxError
+                continue
+
+            files[path] = (version, name or os.path.basename(path)[:-len(HOST_PARAMETER_MAP_EXTENSION)], slots)
+            changed = True
+
+        if changed or len(files) != len(self._files):
+            self._files = files
+            self._maps = dict((name, (version, slots)) for version, name, slots in files.values())
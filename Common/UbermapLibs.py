@@ -1,15 +1,77 @@
-from Ubermap.configobj import ConfigObj
+from Ubermap.UbermapBundle import UbermapBundle
+from Ubermap.UbermapConfigParser import parse_config, config_to_data, data_to_config
+from Ubermap.UbermapWatcher import UbermapWatcher
+from Ubermap import six
+from collections import OrderedDict, deque
+import atexit
+import hashlib
 import os
+import stat
+import sys
+import threading
+import time
+import unicodedata
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    from thread import get_ident
+except ImportError:
+    from threading import get_ident
 
 LOG_ENABLED = True
+# Queued log records are written out every LOG_FLUSH_INTERVAL seconds, or once LOG_FLUSH_SIZE of them are waiting
+LOG_FLUSH_INTERVAL = 1.0
+LOG_FLUSH_SIZE = 256
+LOG_BUFFER_SIZE = 10000
+# Seconds between checks whether the log levels in global.cfg have changed
+LOG_LEVEL_CHECK_INTERVAL = 1.0
+# Debug and info messages are aggregated over windows of LOG_AGGREGATE_WINDOW seconds, writing at most
+# LOG_RATE_LIMIT different lines per message and window, see UbermapLogger
+LOG_AGGREGATE_WINDOW = 10.0
+LOG_RATE_LIMIT = 20
 UBERMAP_ROOT = MAPPING_DIRECTORY = os.path.join(os.path.expanduser("~"), 'Ubermap')
 
+CONFIG_CACHE_ENABLED = True
+CONFIG_CACHE_ROOT = os.path.join(UBERMAP_ROOT, '.cache')
+# Bump whenever the layout of cached entries changes, so stale cache files are ignored
+CONFIG_CACHE_VERSION = 1
+# Built with python -m Ubermap.UbermapBundle, see UbermapBundle.py
+CONFIG_BUNDLE_PATH = os.path.join(UBERMAP_ROOT, 'Devices.bundle')
+# Whether device config file names are matched regardless of case, as on the default file systems of macOS and Windows
+DEVICE_NAMES_IGNORE_CASE = sys.platform == 'darwin' or os.path.normcase('A') == 'a'
+
 
 class UbermapLogger:
+    """Logs are written by a background thread, so logging never waits for the disk on Live's main thread.
+    Records are queued in a bounded buffer (dropping the oldest ones if the writer can't keep up) and written
+    in batches every LOG_FLUSH_INTERVAL seconds, or as soon as LOG_FLUSH_SIZE records are waiting.
+
+    Messages can be given %-style arguments or as a callable, e.g. log.debug('value: %s', value), which are only
+    formatted if the level is enabled.
+
+    Debug and info messages are aggregated per message (the format string, not the formatted text) over windows
+    of LOG_AGGREGATE_WINDOW seconds: repeats of the same line are only counted, and at most LOG_RATE_LIMIT
+    different lines are written per message and window. Both are summarised when the window closes."""
+
     _log_handles = {}
 
     def __init__(self, cfg):
         self.cfg = cfg
+        # deque appends and pops are atomic, so records can be queued from any thread without a lock
+        self._records = deque(maxlen = LOG_BUFFER_SIZE)
+        self._wakeup = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        # (log name, message key) -> aggregation window, only used by flush
+        self._windows = {}
+        self._levels = {}
+        self._levels_generation = None
+        self._levels_checked = None
+        atexit.register(self.flush, True)
 
     def _get_log_file(self, name):
         if name in self._log_handles:
@@ -19,33 +81,372 @@ class UbermapLogger:
         self._log_handles[name] = log_h
         return log_h
 
-    def write(self, msg, name = None):
+    def write(self, msg, name = None, key = None):
+        # Messages with a key are aggregated with other messages with the same key, see flush
         if not LOG_ENABLED:
             return
 
-        if not name:
-            name = 'main'
+        self._records.append((time.time(), get_ident(), name or 'main', key, msg))
+
+        if self._thread is None:
+            self._thread = threading.Thread(target = self._run, name = 'UbermapLogger')
+            self._thread.daemon = True
+            self._thread.start()
+
+        if len(self._records) >= LOG_FLUSH_SIZE:
+            self._wakeup.set()
+
+    def flush(self, close_windows = False):
+        """Write out all queued records now, and the summaries of aggregation windows that have ended (or of all
+        of them, if close_windows is set)."""
+        with self._flush_lock:
+            written = set()
+            while self._records:
+                timestamp, thread_id, name, key, msg = self._records.popleft()
+                if key is None or self._aggregate(timestamp, thread_id, name, key, msg, written):
+                    self._write_line(timestamp, thread_id, name, msg, written)
+
+            now = time.time()
+            for window_key, window in list(self._windows.items()):
+                if close_windows or now - window['start'] >= LOG_AGGREGATE_WINDOW:
+                    self._close_window(window_key, window, now, written)
+
+            for name in written:
+                try:
+                    self._log_handles[name].flush()
+                except (IOError, OSError):
+                    pass
+
+    def _aggregate(self, timestamp, thread_id, name, key, msg, written):
+        # Returns whether msg should be written now
+        window_key = (name, key)
+        window = self._windows.get(window_key)
+        if window is not None and timestamp - window['start'] >= LOG_AGGREGATE_WINDOW:
+            self._close_window(window_key, window, timestamp, written)
+            window = None
+
+        if window is None:
+            window = self._windows[window_key] = {'start': timestamp, 'thread_id': thread_id, 'repeats': OrderedDict(),
+                                                  'suppressed': 0, 'last_suppressed': None}
+
+        repeats = window['repeats']
+        if msg in repeats:
+            repeats[msg] += 1
+            return False
+
+        if len(repeats) >= LOG_RATE_LIMIT:
+            window['suppressed'] += 1
+            window['last_suppressed'] = msg
+            return False
+
+        repeats[msg] = 0
+        return True
+
+    def _close_window(self, window_key, window, timestamp, written):
+        del self._windows[window_key]
+        name = window_key[0]
+        seconds = timestamp - window['start']
 
-        self._get_log_file(name).write(msg + '\n')
-        self._get_log_file(name).flush()
+        for msg, count in window['repeats'].items():
+            if count:
+                self._write_line(timestamp, window['thread_id'], name,
+                                 msg + ' (repeated %d more times in %.0fs)' % (count, seconds), written)
 
-    def debug(self, msg, name = None):
-        pass
-        if self.cfg.get('Log', 'Debug') == 'True':
-            self.write('DEBUG: ' + msg, name)
+        if window['suppressed']:
+            self._write_line(timestamp, window['thread_id'], name,
+                             '%d more similar messages in %.0fs suppressed, last one: %s'
+                             % (window['suppressed'], seconds, window['last_suppressed']), written)
 
-    def info(self, msg, name = None):
-        pass
-        if self.cfg.get('Log', 'Info') == 'True':
-            self.write('INFO: ' + msg, name)
+    def _write_line(self, timestamp, thread_id, name, msg, written):
+        try:
+            self._get_log_file(name).write(time.strftime('%H:%M:%S', time.localtime(timestamp)) +
+                                           '.%03d [%x] %s\n' % ((timestamp % 1) * 1000, thread_id, msg))
+            written.add(name)
+        except (IOError, OSError, UnicodeError):
+            pass
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(LOG_FLUSH_INTERVAL)
+            self._wakeup.clear()
+            self.flush()
+
+    def is_enabled(self, level):
+        """Whether messages of level ('Debug' or 'Info') are logged. The levels are read from global.cfg again
+        only when it has changed."""
+        now = time.time()
+        if self._levels_checked is None or now - self._levels_checked >= LOG_LEVEL_CHECK_INTERVAL:
+            self._levels_checked = now
+            generation = self.cfg.get_generation()
+            if generation != self._levels_generation:
+                self._levels_generation = generation
+                self._levels = {'Debug': self.cfg.get('Log', 'Debug') == 'True',
+                                'Info': self.cfg.get('Log', 'Info') == 'True'}
+
+        return self._levels.get(level, False)
+
+    def _format(self, msg, args):
+        if callable(msg):
+            msg = msg()
+        return msg % args if args else msg
+
+    def _key(self, level, msg):
+        # Callables passed as messages are usually lambdas, which are new objects on every call
+        return level, getattr(msg, '__code__', msg)
+
+    def debug(self, msg, *args, **kwargs):
+        if self.is_enabled('Debug'):
+            self.write('DEBUG: ' + self._format(msg, args), kwargs.get('name'), self._key('Debug', msg))
+
+    def info(self, msg, *args, **kwargs):
+        if self.is_enabled('Info'):
+            self.write('INFO: ' + self._format(msg, args), kwargs.get('name'), self._key('Info', msg))
+
+    def error(self, msg, *args, **kwargs):
+        self.write('ERROR: ' + self._format(msg, args), kwargs.get('name'))
+        self._wakeup.set()
+
+
+class UbermapConfigCache:
+    """Persistent on-disk cache of parsed configs, keyed by source path, mtime and size.
+
+    Entries are stored as plain nested (key, value) pairs rather than ConfigObj instances, so they can be
+    loaded back without going through the ConfigObj parser and survive ConfigObj upgrades."""
+
+    def __init__(self, root = CONFIG_CACHE_ROOT):
+        self.root = root
+
+    def get_cache_path(self, path):
+        path = os.path.abspath(path)
+        if isinstance(path, six.text_type):
+            path = path.encode('utf-8')
+        key = hashlib.md5(path).hexdigest()
+        return os.path.join(self.root, key + '.pickle')
+
+    def get(self, path, mtime, size):
+        try:
+            with open(self.get_cache_path(path), 'rb') as f:
+                entry = pickle.load(f)
+        except Exception:
+            return None
+
+        if entry.get('version') != CONFIG_CACHE_VERSION or entry.get('path') != os.path.abspath(path) \
+                or entry.get('mtime') != mtime or entry.get('size') != size:
+            return None
+
+        return data_to_config(entry['data'])
+
+    def put(self, path, mtime, size, config):
+        entry = {
+            'version': CONFIG_CACHE_VERSION,
+            'path': os.path.abspath(path),
+            'mtime': mtime,
+            'size': size,
+            'data': config_to_data(config)
+        }
+
+        cache_path = self.get_cache_path(path)
+        # Configs can be loaded by the preloader thread and the main thread at the same time
+        tmp_path = cache_path + '.' + str(os.getpid()) + '.' + str(threading.current_thread().ident) + '.tmp'
+        try:
+            if not os.path.isdir(self.root):
+                os.makedirs(self.root)
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(entry, f, 2)
+            if os.path.exists(cache_path):
+                os.remove(cache_path)
+            os.rename(tmp_path, cache_path)
+        except (IOError, OSError):
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
 
-    def error(self, msg, name = None):
-        self.write('ERROR: ' + msg, name)
+        return True
+
+
+def estimate_size(data):
+    # Rough size in bytes of a parsed config, counting containers, keys and values
+    size = sys.getsizeof(data)
+    if isinstance(data, dict):
+        for k in data:
+            size += sys.getsizeof(k) + estimate_size(dict.__getitem__(data, k))
+    elif isinstance(data, (list, tuple)):
+        for v in data:
+            size += estimate_size(v)
+    return size
+
+
+def device_name_key(name):
+    # Key of a device name in the device index, so that names match config file names the way the file system
+    # would: macOS hands out decomposed (NFD) file names while Live's device names are usually composed
+    if not isinstance(name, six.text_type):
+        name = name.decode(sys.getfilesystemencoding() or 'utf-8', 'replace')
+    name = unicodedata.normalize('NFC', name)
+    return name.lower() if DEVICE_NAMES_IGNORE_CASE else name
+
+
+class UbermapLRUCache:
+    """Least recently used cache bounded by entry count and estimated size in bytes. A limit of 0 means
+    unlimited. The most recently added entry is never evicted, even if it exceeds max_bytes on its own."""
+
+    def __init__(self, max_entries = 0, max_bytes = 0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._sizes = {}
+        # The config watcher invalidates entries from its own thread
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries[key] = entry
+            self.hits += 1
+            return entry
+
+    def peek(self, key):
+        # Get an entry without counting it as a use
+        return self._entries.get(key)
+
+    def put(self, key, entry, size):
+        with self._lock:
+            self.pop(key)
+            self._entries[key] = entry
+            self._sizes[key] = size
+            self.bytes += size
+            self._evict()
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.bytes -= self._sizes.pop(key)
+            return entry
+
+    def values(self):
+        with self._lock:
+            return list(self._entries.values())
+
+    def resize(self, max_entries, max_bytes):
+        with self._lock:
+            self.max_entries = max_entries
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def _evict(self):
+        while len(self._entries) > 1 and ((self.max_entries and len(self._entries) > self.max_entries) or
+                                          (self.max_bytes and self.bytes > self.max_bytes)):
+            key, _ = self._entries.popitem(last=False)
+            self.bytes -= self._sizes.pop(key)
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
 
 
 class UbermapConfig:
 
-    _config_cache = {}
+    # Parsed configs keyed by absolute file path, see configure() for the limits
+    _config_cache = UbermapLRUCache(max_entries = 512, max_bytes = 16 * 1024 * 1024)
+    _persistent_cache = UbermapConfigCache()
+    _bundle = UbermapBundle(CONFIG_BUNDLE_PATH)
+
+    # Minimum number of seconds between two mtime checks of the same config file, so that repeated get() calls
+    # are served from memory. Changes on disk are still picked up within this delay. Not used while the config
+    # folders are being watched for changes.
+    check_interval = 1.0
+
+    # Maps device names to the config paths found in the Devices folder. Any name missing from it has no config,
+    # so unconfigured devices can be answered without touching the filesystem.
+    _device_index = None
+
+    # Incremented for every config (re)loaded into the cache, so anything derived from a config can tell which
+    # version of it it was derived from
+    _generation = 0
+    _generation_lock = threading.Lock()
+
+    # Entries loaded by the preloader thread, waiting to be added to the cache on the main thread. deque appends
+    # and pops are atomic, so no locking is needed to hand them over.
+    _preloaded = deque()
+    # Paths handed to the preloader thread and not added to the cache yet, only used on the main thread
+    _preloading = set()
+    # Live's main thread, which imports this module. Configs can also be read from other threads (e.g. the log
+    # writer or the tracer), but only the main thread takes over preloaded entries.
+    _main_thread = get_ident()
+
+    _watcher = None
+    # Incremented for every change reported by the watcher, so a load racing with a change doesn't mark the
+    # config it just read as fresh
+    _watch_epoch = 0
+
+    def configure(self, cfg):
+        if not cfg:
+            return
+
+        check_interval = cfg.get('Cache', 'CheckInterval')
+        if check_interval is not None:
+            try:
+                self.check_interval = float(check_interval)
+                self._bundle.check_interval = self.check_interval
+            except ValueError:
+                log.error('invalid Cache CheckInterval: %s', check_interval)
+
+        try:
+            max_entries = int(cfg.get('Cache', 'MaxEntries') or self._config_cache.max_entries)
+            max_bytes = int(cfg.get('Cache', 'MaxBytes') or self._config_cache.max_bytes)
+            self._config_cache.resize(max_entries, max_bytes)
+        except ValueError:
+            log.error('invalid Cache MaxEntries/MaxBytes: %s/%s', cfg.get('Cache', 'MaxEntries'),
+                      cfg.get('Cache', 'MaxBytes'))
+
+        if cfg.get('Cache', 'Watch') != 'False':
+            self.start_watcher()
+
+    def start_watcher(self):
+        if self._watcher is None:
+            self._watcher = UbermapWatcher([UBERMAP_ROOT, self.get_path('Devices')], self._on_watched_change)
+
+        if self._watcher.start():
+            log.info('watching for config changes')
+        else:
+            log.info('config watcher not available, checking for config changes every %ss', self.check_interval)
+
+    def _on_watched_change(self, path):
+        # Called from the watcher thread
+        if path is not None and not path.endswith('.cfg') and not os.path.isdir(path):
+            return
+
+        self._watch_epoch += 1
+        if self._device_index is not None:
+            self._device_index['checked'] = None
+
+        if path is None or not path.endswith('.cfg'):
+            self.invalidate()
+            return
+
+        entry = self._config_cache.peek(path)
+        if entry is not None:
+            entry['checked'] = None
 
     def get_path(self, name, subdir1 = None):
         if subdir1:
@@ -55,51 +456,286 @@ class UbermapConfig:
 
         return path
 
-    def load(self, name, subdir = None, log_enabled = True):
-        path = self.get_path(name, subdir1=subdir) + ".cfg"
+    def get_config_path(self, name, subdir = None):
+        return os.path.abspath(self.get_path(name, subdir1=subdir) + ".cfg")
 
-        if not os.path.isfile(path):
-            if log_enabled:
-                log.info('config not found: ' + path)
+    def invalidate(self, path = None):
+        # Force the next access to check the config file(s) on disk again
+        entries = self._config_cache.values() if path is None else [self._config_cache.peek(path)]
+        if path is None:
+            entries.append(self._device_index)
+
+        for entry in entries:
+            if entry:
+                entry['checked'] = None
+
+    def _is_recently_checked(self, entry):
+        if not entry or entry['checked'] is None:
             return False
 
-        mtime = os.path.getmtime(path)
+        if self._watcher is not None and self._watcher.is_running():
+            return True
+
+        return time.time() - entry['checked'] < self.check_interval
+
+    def is_fresh(self, path):
+        return self._is_recently_checked(self._config_cache.peek(path))
+
+    def cache_stats(self):
+        return self._config_cache.stats()
+
+    def get_device_index(self):
+        index = self._device_index
+        if self._is_recently_checked(index):
+            return index
+
+        devices_folder = self.get_path('Devices')
+        now = time.time()
+        epoch = self._watch_epoch
+
+        try:
+            mtime = os.stat(devices_folder).st_mtime
+        except OSError:
+            mtime = None
+
+        # A folder changed within the same second as the last scan might have changed again without its mtime
+        # moving on, so only trust an unchanged mtime once the scan happened well after it
+        if index is None or index['mtime'] != mtime or not index['settled']:
+            index = {
+                'mtime': mtime,
+                'settled': mtime is None or now - mtime > 1.0,
+                'names': self._scan_device_configs(devices_folder) if mtime is not None else {},
+                'missing': set()
+            }
+            self._device_index = index
+
+        index['checked'] = now if epoch == self._watch_epoch else None
+        return index
+
+    def _scan_device_configs(self, devices_folder):
+        names = {}
+        scandir = getattr(os, 'scandir', None)
+
+        try:
+            if scandir is not None:
+                entries = [(e.name, e.path) for e in scandir(devices_folder) if e.name.endswith('.cfg') and e.is_file()]
+            else:
+                entries = [(n, os.path.join(devices_folder, n)) for n in os.listdir(devices_folder)
+                           if n.endswith('.cfg') and os.path.isfile(os.path.join(devices_folder, n))]
+        except OSError as e:
+            log.error('error scanning device configs: %s %s', devices_folder, e)
+            return names
+
+        for file_name, path in entries:
+            names[device_name_key(file_name[:-len('.cfg')])] = path[:-len('.cfg')]
+
+        log.debug('indexed %d device configs in %s', len(names), devices_folder)
+        return names
+
+    def load(self, name, subdir = None, log_enabled = True, persistent = False):
+        path = self.get_config_path(name, subdir)
+        if self._load_config(path, log_enabled, persistent) is None:
+            return False
+
+        return UbermapConfigProxy(self, path, log_enabled, persistent)
+
+    def _read_config(self, path, mtime, size, persistent):
+        # Returns the parsed config and whether it came from the bundle or persistent cache. Doesn't log or touch
+        # the in-memory cache, so it's safe to call from the preloader thread.
+        use_persistent_cache = persistent and CONFIG_CACHE_ENABLED
+        if use_persistent_cache and os.path.dirname(path) == self.get_path('Devices'):
+            data = self._bundle.get(os.path.basename(path)[:-len('.cfg')], mtime, size)
+            if data is not None:
+                return data_to_config(data), True
+
+        if use_persistent_cache:
+            config = self._persistent_cache.get(path, mtime, size)
+            if config is not None:
+                return config, True
+
+        config = parse_config(path)
+        if use_persistent_cache:
+            self._persistent_cache.put(path, mtime, size, config)
+        return config, False
+
+    def _new_entry(self, mtime, size, config, compiled = None):
+        with self._generation_lock:
+            UbermapConfig._generation += 1
+            generation = UbermapConfig._generation
+
+        return {
+            'mtime': mtime,
+            'size': size,
+            'generation': generation,
+            'config': config,
+            'compiled': compiled or {}
+        }
+
+    def _load_config(self, path, log_enabled, persistent):
+        # Returns the cache entry for the config at path, or None. Callers must read what they need from it rather
+        # than peek into the cache afterwards, as logging may reload global.cfg and evict it in between.
+        if self._preloaded and get_ident() == self._main_thread:
+            self._add_preloaded()
+
+        entry = self._config_cache.get(path)
+        if self._is_recently_checked(entry):
+            return entry
+
+        now = time.time()
+        epoch = self._watch_epoch
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+
+        if st is None or not stat.S_ISREG(st.st_mode):
+            if log_enabled:
+                log.info('config not found: %s', path)
+            return None
+
+        mtime = st.st_mtime
         if log_enabled:
-            log.debug('looking for config in cache: ' + name + ', timestamp: ' + str(mtime))
+            log.debug('looking for config in cache: %s, timestamp: %s', path, mtime)
 
-        if name in self._config_cache and self._config_cache[name]['mtime'] == mtime:
+        if entry is not None and entry['mtime'] == mtime and entry['size'] == st.st_size:
             if log_enabled:
-                log.debug('found config in cache: ' + name + ', timestamp: ' + str(mtime))
-            config = self._config_cache[name]['config']
+                log.debug('found config in cache: %s, timestamp: %s', path, mtime)
         else:
             try:
-                config = ConfigObj(path)
+                config, from_persistent_cache = self._read_config(path, mtime, st.st_size, persistent)
                 if log_enabled:
-                    log.debug('parsed config: ' + path)
+                    log.debug('loaded config from bundle or persistent cache: %s' if from_persistent_cache
+                              else 'parsed config: %s', path)
 
-                self._config_cache[name] = {}
-                self._config_cache[name]['mtime'] = mtime
-                self._config_cache[name]['config'] = config
+                entry = self._new_entry(mtime, st.st_size, config)
+                self._config_cache.put(path, entry, estimate_size(config))
             except Exception as e:
                 if log_enabled:
-                    log.error('error parsing config: ' + path + " " + str(e))
+                    log.error('error parsing config: %s %s', path, e)
                 raise e
                 # return False
 
-        return UbermapConfigProxy(self, name, subdir, log_enabled)
+        entry['checked'] = now if epoch == self._watch_epoch else None
+        return entry
+
+    def preload(self, limit, compilers = None, device_names = None):
+        """Load up to limit device configs that aren't cached yet, most recently modified first, on a background
+        thread. Only the configs for device_names are loaded if given. compilers maps get_compiled keys to
+        functions that are also run on the background thread for every preloaded config."""
+        if self._config_cache.max_entries:
+            limit = min(limit, self._config_cache.max_entries)
+
+        names = self.get_device_index()['names']
+        if device_names is not None:
+            keys = [device_name_key(name) for name in device_names]
+            paths = [names[key] + ".cfg" for key in keys if key in names]
+        else:
+            paths = [path + ".cfg" for path in names.values()]
+
+        paths = [path for path in paths if path not in self._config_cache and path not in self._preloading]
+        limit = min(limit, len(paths))
+        if limit <= 0:
+            return
+
+        log.info('preloading %d device configs', limit)
+
+        self._preloading.update(paths)
+        thread = threading.Thread(target=self._preload, name='UbermapPreloader',
+                                  args=(paths, limit, compilers or {}, self._watch_epoch))
+        thread.daemon = True
+        thread.start()
+
+    def _preload(self, paths, limit, compilers, epoch):
+        # Runs on the preloader thread, so it must not log or touch the cache: finished entries are handed over
+        # to the main thread through _preloaded
+        files = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                self._preloaded.append((path, None))
+                continue
+            files.append((st.st_mtime, st.st_size, path))
+
+        files.sort(reverse=True)
+        for mtime, size, path in files[limit:]:
+            self._preloaded.append((path, None))
+
+        for mtime, size, path in files[:limit]:
+            checked = time.time()
+            try:
+                config, _ = self._read_config(path, mtime, size, True)
+                compiled = {}
+                for key, compile in compilers.items():
+                    value = compile(config)
+                    if value is not None:
+                        compiled[key] = value
+            except Exception:
+                # The main thread will report the error when it loads this config itself
+                self._preloaded.append((path, None))
+                continue
+
+            self._preloaded.append((path, (mtime, size, config, compiled, estimate_size(config), checked, epoch)))
+
+    def _add_preloaded(self):
+        count = 0
+        while self._preloaded:
+            path, preloaded = self._preloaded.popleft()
+            self._preloading.discard(path)
+
+            # Anything loaded on the main thread in the meantime is at least as recent
+            if preloaded is None or path in self._config_cache:
+                continue
+
+            mtime, size, config, compiled, size_estimate, checked, epoch = preloaded
+            entry = self._new_entry(mtime, size, config, compiled)
+            entry['checked'] = checked if epoch == self._watch_epoch else None
+            self._config_cache.put(path, entry, size_estimate)
+            count += 1
+
+        if count:
+            log.debug('added %d preloaded configs', count)
+
+    def get_generation(self, path, log_enabled = True, persistent = False):
+        entry = self._load_config(path, log_enabled, persistent)
+        if entry is None:
+            return None
+
+        return entry['generation']
+
+    def get_compiled(self, path, key, compile, log_enabled = True, persistent = False):
+        # Returns compile(config), computed once per version of the config and dropped along with it
+        entry = self._load_config(path, log_enabled, persistent)
+        if entry is None:
+            return None
+
+        compiled = entry['compiled']
+        if key not in compiled:
+            compiled[key] = compile(entry['config'])
+        return compiled[key]
 
     def load_device_config(self, device_name):
-        devices_folder = config.get_path('Devices')
+        index = self.get_device_index()
+        key = device_name_key(device_name)
+        name = index['names'].get(key)
+
+        if name is None:
+            if key not in index['missing']:
+                index['missing'].add(key)
+                log.debug('no config for device: %s', device_name)
+            return None
 
-        if os.path.exists(os.path.join(devices_folder, device_name + ".cfg")):
-            return self.load(os.path.join(devices_folder, device_name))
+        return self.load(name, persistent = True)
 
-        return None
+    def get(self, path, key, log_enabled, persistent = False):
+        entry = self._load_config(path, log_enabled, persistent)
+        if entry is None:
+            return None
+
+        data = entry['config']
 
-    def get(self, name, key, subdir, log_enabled):
-        self.load(name, subdir, log_enabled)
         try:
-            data = self._config_cache[name]['config']
             for k in key:
                 data = data[k]
             return data
@@ -108,21 +744,29 @@ class UbermapConfig:
 
 
 class UbermapConfigProxy:
-    def __init__(self, config_provider, name, subdir, log_enabled):
+    def __init__(self, config_provider, path, log_enabled, persistent = False):
         self.config_provider = config_provider
-        self.name = name
-        self.subdir = subdir
+        self.path = path
         self.log_enabled = log_enabled
+        self.persistent = persistent
 
     def get(self, *key):
-        return self.config_provider.get(self.name, key, self.subdir, self.log_enabled)
+        return self.config_provider.get(self.path, key, self.log_enabled, self.persistent)
+
+    def get_generation(self):
+        return self.config_provider.get_generation(self.path, self.log_enabled, self.persistent)
+
+    def get_compiled(self, key, compile):
+        return self.config_provider.get_compiled(self.path, key, compile, self.log_enabled, self.persistent)
 
 
 config = UbermapConfig()
-log = UbermapLogger(config.load('global', log_enabled = False))
+global_config = config.load('global', log_enabled = False)
+log = UbermapLogger(global_config)
+config.configure(global_config)
 
 
 def log_call(msg):
-    log = log.debug('CALL: ' + msg, 'main')
+    log.debug('CALL: %s', msg, name = 'main')
 
 
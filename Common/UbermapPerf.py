@@ -0,0 +1,96 @@
+# Ubermap performance stats
+# Optional timing of the functions Ubermap patches into Live's Push scripts, to tell whether Ubermap is what makes
+# Push feel slow. Call counts and latency percentiles per function and device are written to ~/Ubermap/perf.log.
+
+from Ubermap.UbermapLibs import log
+from collections import deque
+import threading
+import time
+
+try:
+    timer = time.perf_counter
+except AttributeError:
+    timer = time.time
+
+# Most recent samples kept per function and device in each interval, to compute percentiles from
+PERF_MAX_SAMPLES = 1000
+
+
+def percentile(sorted_samples, p):
+    return sorted_samples[min(int(len(sorted_samples) * p), len(sorted_samples) - 1)]
+
+
+class UbermapPerf:
+    """Collects timings of wrapped functions and writes a report to perf.log every interval seconds. When it's
+    disabled, timed() returns functions unchanged, so there's no overhead at all."""
+
+    def __init__(self, enabled = False, interval = 60.0):
+        self.enabled = enabled
+        self.interval = interval
+        # (function name, device name) -> [call count, longest duration, recent durations]
+        self._stats = {}
+        self._started = time.time()
+
+    def timed(self, name, function, get_device_name = None):
+        """Returns function wrapped to record its duration under name, and under the name of the device
+        get_device_name(args) returns, if given."""
+        if not self.enabled:
+            return function
+
+        def timed_function(*args, **kwargs):
+            start = timer()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = timer() - start
+                device_name = None
+                if get_device_name is not None:
+                    try:
+                        device_name = get_device_name(args)
+                    except (AttributeError, IndexError):
+                        pass
+                self.record(name, device_name, elapsed)
+
+        timed_function.__name__ = function.__name__
+        return timed_function
+
+    def record(self, name, device_name, elapsed):
+        stats = self._stats.get((name, device_name))
+        if stats is None:
+            stats = self._stats[(name, device_name)] = [0, 0.0, deque(maxlen = PERF_MAX_SAMPLES)]
+        stats[0] += 1
+        stats[1] = max(stats[1], elapsed)
+        stats[2].append(elapsed)
+
+        now = time.time()
+        if now - self._started >= self.interval:
+            # Sorting the samples and writing the report is left to another thread
+            stats, self._stats = self._stats, {}
+            thread = threading.Thread(target = self._report, args = (stats, now - self._started),
+                                      name = 'UbermapPerf')
+            thread.daemon = True
+            thread.start()
+            self._started = now
+
+    def _report(self, stats, seconds):
+        functions = {}
+        for (name, device_name), (count, longest, samples) in stats.items():
+            function = functions.setdefault(name, [0, 0.0, []])
+            function[0] += count
+            function[1] = max(function[1], longest)
+            function[2].extend(samples)
+
+        lines = ['stats for the last %.0fs (times in ms):' % seconds]
+        for name in sorted(functions):
+            lines.append(self._format_stats(name, 'all devices', *functions[name]))
+            for (function_name, device_name), device_stats in sorted(stats.items(), key = lambda x: str(x[0])):
+                if function_name == name and device_name is not None:
+                    lines.append(self._format_stats(name, device_name, *device_stats))
+
+        log.write('\n'.join(lines), 'perf')
+
+    def _format_stats(self, name, device_name, count, longest, samples):
+        samples = sorted(samples)
+        return '  %s [%s]: %d calls, p50 %.3f, p95 %.3f, p99 %.3f, max %.3f' % (
+            name, device_name, count, percentile(samples, 0.5) * 1000, percentile(samples, 0.95) * 1000,
+            percentile(samples, 0.99) * 1000, longest * 1000)
@@ -0,0 +1,134 @@
+# Ubermap tracer
+# Sampling profiler for Live's main thread, to see where the time goes while using Push. Switched on and off at
+# runtime with "Enabled" in the [Trace] section of ~/Ubermap/global.cfg. While it's on, the stack of the main
+# thread is sampled every SampleInterval seconds into a bounded buffer, which is written to ~/Ubermap/trace.folded
+# as collapsed stacks ("outer;inner;innermost count" lines) that flamegraph.pl or speedscope can read.
+
+from Ubermap.UbermapLibs import log
+from collections import deque
+import os
+import sys
+import threading
+import time
+
+try:
+    from thread import get_ident
+except ImportError:
+    from threading import get_ident
+
+TRACE_MAX_SAMPLES = 20000
+TRACE_MAX_DEPTH = 64
+# Seconds between checks whether the [Trace] settings have changed
+TRACE_CHECK_INTERVAL = 1.0
+# Seconds between writes of the collapsed stacks while tracing
+TRACE_EXPORT_INTERVAL = 10.0
+
+
+class UbermapTracer:
+    """Samples the stack of the thread that created it (or thread_id) from a background thread, which checks cfg
+    for changes to the [Trace] settings once a second and sleeps in between while tracing is off."""
+
+    def __init__(self, cfg, export_path, thread_id = None):
+        self.cfg = cfg
+        self.export_path = export_path
+        self.thread_id = thread_id or get_ident()
+        self.enabled = False
+        self.interval = 0.01
+        # Only touched by the tracer thread
+        self._samples = deque(maxlen = TRACE_MAX_SAMPLES)
+        self._labels = {}
+        self._generation = None
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+
+        self._thread = threading.Thread(target = self._run, name = 'UbermapTracer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self._trace()
+            except Exception as e:
+                # Keep the tracer switchable, whatever went wrong
+                log.error('tracer error: %s', e)
+                self.enabled = False
+                self._generation = None
+                time.sleep(TRACE_CHECK_INTERVAL)
+
+    def _trace(self):
+        checked = None
+        exported = None
+        while True:
+            now = time.time()
+            if checked is None or now - checked >= TRACE_CHECK_INTERVAL:
+                checked = now
+                was_enabled = self.enabled
+                self._read_settings()
+
+                if was_enabled and not self.enabled:
+                    self.export()
+                elif self.enabled and not was_enabled:
+                    self._samples.clear()
+                    exported = now
+
+            if not self.enabled:
+                time.sleep(TRACE_CHECK_INTERVAL)
+                continue
+
+            self.sample()
+            if now - exported >= TRACE_EXPORT_INTERVAL:
+                self.export()
+                exported = now
+            time.sleep(self.interval)
+
+    def _read_settings(self):
+        generation = self.cfg.get_generation()
+        if generation == self._generation:
+            return
+        self._generation = generation
+
+        self.enabled = self.cfg.get('Trace', 'Enabled') == 'True'
+        try:
+            self.interval = max(float(self.cfg.get('Trace', 'SampleInterval') or 0.01), 0.001)
+        except ValueError:
+            self.interval = 0.01
+
+    def sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        stack = []
+        while frame is not None and len(stack) < TRACE_MAX_DEPTH:
+            stack.append(self._label(frame.f_code))
+            frame = frame.f_back
+
+        if stack:
+            stack.reverse()
+            self._samples.append(tuple(stack))
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            # ; separates frames in collapsed stacks
+            label = self._labels[code] = (os.path.basename(code.co_filename) + ':' + code.co_name).replace(';', ':')
+        return label
+
+    def export(self):
+        """Write the samples in the buffer to export_path as collapsed stacks."""
+        counts = {}
+        for stack in self._samples:
+            counts[stack] = counts.get(stack, 0) + 1
+
+        tmp_path = self.export_path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                for stack, count in sorted(counts.items(), key = lambda x: -x[1]):
+                    f.write(';'.join(stack) + ' ' + str(count) + '\n')
+
+            if os.path.exists(self.export_path):
+                os.remove(self.export_path)
+            os.rename(tmp_path, self.export_path)
+        except (IOError, OSError):
+            pass
@@ -0,0 +1,161 @@
+# Ubermap config watcher
+# Uses Linux inotify (via ctypes) to get notified about changes to config files, so the config cache doesn't
+# have to poll modification times. Not available on other platforms, where callers should fall back to polling.
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import threading
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_CLOEXEC = 0o2000000
+
+# IN_MODIFY is left out on purpose: log files in the watched folders are written continuously but never closed,
+# and editors saving a config always close or rename the file afterwards
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+              IN_DELETE_SELF | IN_MOVE_SELF)
+
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def _load_libc():
+    if not sys.platform.startswith('linux'):
+        return None
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    except OSError:
+        return None
+
+    if not hasattr(libc, 'inotify_init1') or not hasattr(libc, 'inotify_add_watch'):
+        return None
+
+    return libc
+
+
+class UbermapWatcher:
+    """Watches a set of directories and calls callback(path) from a background thread whenever an entry in one
+    of them changes. callback(None) means events may have been lost and everything should be considered
+    changed."""
+
+    _libc = None
+
+    def __init__(self, directories, callback):
+        self.directories = directories
+        self.callback = callback
+        self._fd = None
+        self._wakeup = None
+        self._watches = {}
+        self._thread = None
+        self._running = False
+
+    @classmethod
+    def is_available(cls):
+        if cls._libc is None:
+            cls._libc = _load_libc() or False
+        return bool(cls._libc)
+
+    def is_running(self):
+        return self._running and self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.is_running():
+            return True
+
+        if not self.is_available():
+            return False
+
+        fd = self._libc.inotify_init1(IN_CLOEXEC)
+        if fd < 0:
+            return False
+
+        for directory in self.directories:
+            wd = -1
+            if os.path.isdir(directory):
+                wd = self._libc.inotify_add_watch(fd, os.path.abspath(directory).encode(sys.getfilesystemencoding()),
+                                                  WATCH_MASK)
+            if wd < 0:
+                # Changes in a directory we can't watch would go unnoticed, so leave it all to polling
+                os.close(fd)
+                self._watches = {}
+                return False
+
+            self._watches[wd] = os.path.abspath(directory)
+
+        self._fd = fd
+        self._running = True
+        self._wakeup = os.pipe()
+        self._thread = threading.Thread(target=self._run, name='UbermapWatcher')
+        self._thread.daemon = True
+        self._thread.start()
+        return True
+
+    def stop(self):
+        if not self.is_running():
+            return
+
+        os.write(self._wakeup[1], b'x')
+        self._thread.join(1.0)
+
+    def _run(self):
+        try:
+            while True:
+                try:
+                    ready, _, _ = select.select([self._fd, self._wakeup[0]], [], [])
+                except (OSError, select.error) as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+
+                if self._wakeup[0] in ready:
+                    break
+
+                if not self._dispatch(os.read(self._fd, 64 * 1024)):
+                    break
+        finally:
+            self._running = False
+            for fd in (self._fd, self._wakeup[0], self._wakeup[1]):
+                os.close(fd)
+            self._watches = {}
+            # Anything could have changed from now on without us noticing
+            self.callback(None)
+
+    def _dispatch(self, data):
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0').decode(sys.getfilesystemencoding())
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                self.callback(None)
+                continue
+
+            directory = self._watches.get(wd)
+            if directory is None:
+                continue
+
+            if mask & (IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF):
+                # The watched directory itself went away, so we can't tell what happens to it from now on. Stop
+                # watching altogether and leave it all to polling, which notices when it comes back.
+                del self._watches[wd]
+                return False
+
+            self.callback(os.path.join(directory, name) if name else directory)
+
+        return True
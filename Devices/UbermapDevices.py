@@ -1,9 +1,244 @@
 import os.path
-from Ubermap.configobj import ConfigObj
-from functools import partial
+from bisect import bisect_right
+from collections import namedtuple, OrderedDict
 import hashlib
+import io
+from math import floor
 import re
+import threading
+import weakref
 from Ubermap.UbermapLibs import log, log_call, config
+from Ubermap.UbermapHostParameters import UbermapHostParameterMaps
+
+
+# A single mapped parameter: the config key used to find the device parameter, the name to display on Push,
+# and optionally the custom values to display instead of a dial, with the value each one starts at and a function
+# mapping the parameter's value to the index of the custom value to show
+ParameterMapping = namedtuple('ParameterMapping', ['key', 'position', 'name', 'display_name', 'values', 'start_points',
+                                                   'value_to_index'])
+
+
+def parse_parameter_key(key):
+    """Split a mapping key into (position, name): "N_name" addresses the parameter called name at position N,
+    which is None for plain names. "@N" addresses whatever parameter is in host parameter slot N, with a name of
+    None."""
+    if key.startswith('@') and key[1:].isdigit():
+        try:
+            return int(key[1:]), None
+        except ValueError:
+            pass
+
+    prefix, separator, name = key.partition('_')
+    if separator and prefix.isdigit():
+        try:
+            return int(prefix), name
+        except ValueError:
+            # isdigit() accepts digits like superscripts that int() doesn't
+            pass
+    return None, key
+
+
+def start_points_value_to_index(start_points):
+    # start_points are sorted, so the value shown is the one with the last start point <= value. Values below the
+    # first start point show the first value.
+    def value_to_index(value):
+        return max(bisect_right(start_points, value) - 1, 0)
+    return value_to_index
+
+
+def values_value_to_index(values_len):
+    # Values are spread evenly over the parameter's range, 1.0 shows the last one rather than being off by one
+    def value_to_index(value):
+        index = int(floor(value * values_len))
+        return index - 1 if index == values_len else index
+    return value_to_index
+
+
+class DeviceMap:
+    """Immutable, precompiled form of a device config's banks, built once per version of the config so
+    drawing a bank doesn't have to walk the ConfigObj sections again."""
+
+    def __init__(self, device_config, bank_section):
+        banks = device_config[bank_section]
+        self.banks = tuple((bank_name, tuple(self._compile_parameter(device_config, key, name)
+                                             for key, name in banks[bank_name].items()))
+                           for bank_name in banks.sections)
+        self.bank_names = tuple(bank_name for bank_name, _ in self.banks)
+        self.used_parameters = frozenset(mapping.name
+                                         for _, mappings in self.banks for mapping in mappings if mapping.name)
+        # Whether any parameter is addressed by host slot ("@N"), see parse_parameter_key
+        self.has_slot_keys = any(mapping.name is None for _, mappings in self.banks for mapping in mappings)
+
+    def _compile_parameter(self, device_config, key, name):
+        if not name:
+            display_name = key
+        elif name == "*":
+            display_name = " ".join(re.sub('([A-Z][a-z]+)', r' \1', re.sub('([A-Z]+)', r' \1', key)).split())
+        else:
+            display_name = name
+
+        values, start_points = self._compile_parameter_values(device_config, key)
+        if start_points:
+            value_to_index = start_points_value_to_index(start_points)
+        elif values:
+            value_to_index = values_value_to_index(len(values))
+        else:
+            value_to_index = None
+
+        position, parameter_name = parse_parameter_key(key)
+        return ParameterMapping(key, position, parameter_name, display_name, values, start_points, value_to_index)
+
+    def _compile_parameter_values(self, device_config, key):
+        values = device_config.get(UbermapDevices.SECTION_PARAMETER_VALUES, {}).get(key)
+        if not values:
+            return None, None
+
+        # If we don't have an array, i.e. comma separated list, try and look up the string key in
+        # ParameterValueTypes and use that
+        if not isinstance(values, list):
+            values = device_config.get(UbermapDevices.SECTION_PARAMETER_VALUE_TYPES, {}).get(values)
+            if not isinstance(values, list):
+                return None, None
+
+        # Split the values on || to see if we have custom value start points specified
+        values_split = [value.split('||') for value in values]
+        if not all(len(x) == 2 for x in values_split):
+            return tuple(values), None
+
+        # Keep the values ordered by start point, so the index of a start point is the index of its value
+        values_split = sorted(((float(x[1]), x[0]) for x in values_split), key=lambda x: x[0])
+        return tuple(x[1] for x in values_split), tuple(x[0] for x in values_split)
+
+
+class UbermapDumpWriter:
+    """Writes the *_unmapped.txt dumps on a background thread, so the Live main thread never waits for the disk.
+    Requests for the same file are coalesced into the latest one, and files whose content hasn't changed since
+    the last write aren't written again."""
+
+    def __init__(self):
+        self._pending = {}
+        self._hashes = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def write(self, file_path, parameter_names):
+        # An empty list of parameter names removes the file
+        with self._lock:
+            self._pending[file_path] = parameter_names
+
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='UbermapDumpWriter')
+            self._thread.daemon = True
+            self._thread.start()
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+
+            with self._lock:
+                pending, self._pending = self._pending, {}
+
+            for file_path, parameter_names in pending.items():
+                try:
+                    self._write(file_path, parameter_names)
+                except Exception:
+                    # Will be tried again the next time the device is dumped, without stopping the other dumps
+                    self._hashes.pop(file_path, None)
+
+    def _write(self, file_path, parameter_names):
+        # Names are byte strings or unicode on Python 2, depending on the plugin
+        names = [name.decode('utf-8', 'replace') if isinstance(name, bytes) else name for name in parameter_names]
+        content = u"".join(u"%s\n" % name for name in sorted(names))
+        content_hash = hashlib.md5(content.encode('utf-8')).digest() if content else None
+
+        if file_path not in self._hashes:
+            # First dump of this file in this session, compare with what an earlier session left
+            self._hashes[file_path] = self._hash_file(file_path)
+
+        if self._hashes[file_path] == content_hash:
+            return
+
+        if content:
+            with io.open(file_path, 'w', encoding='utf-8') as f:
+                f.write(content)
+        elif os.path.isfile(file_path):
+            os.remove(file_path)
+
+        self._hashes[file_path] = content_hash
+
+    def _hash_file(self, file_path):
+        try:
+            with open(file_path, 'rb') as f:
+                return hashlib.md5(f.read()).digest()
+        except (IOError, OSError):
+            return None
+
+
+class UbermapDeviceStates:
+    """Holds a state dict per device until the device's parameter list changes. Devices are referenced weakly, so
+    states of deleted devices go away with them. Devices that can't be weakly referenced are kept in a bounded
+    fallback store instead, which drops the least recently added states first."""
+
+    MAX_FALLBACK_STATES = 256
+
+    def __init__(self):
+        self._states = weakref.WeakKeyDictionary()
+        self._fallback = OrderedDict()
+
+    def get(self, device):
+        try:
+            entry = self._states.get(device)
+        except TypeError:
+            entry = self._fallback.get(device)
+        return entry[0] if entry is not None else None
+
+    def add(self, device, state):
+        try:
+            # The listener mustn't reference the device itself, or the state would keep the device alive
+            device_ref = weakref.ref(device)
+        except TypeError:
+            device_ref = None
+
+        def on_parameters_changed():
+            device = device_ref() if device_ref is not None else fallback_device
+            if device is not None:
+                self.pop(device)
+
+        entry = (state, on_parameters_changed)
+        if device_ref is not None:
+            fallback_device = None
+            self._states[device] = entry
+        else:
+            fallback_device = device
+            self._fallback[device] = entry
+            while len(self._fallback) > self.MAX_FALLBACK_STATES:
+                evicted, (_, listener) = self._fallback.popitem(last=False)
+                self._remove_listener(evicted, listener)
+
+        device.add_parameters_listener(on_parameters_changed)
+
+    def pop(self, device):
+        try:
+            entry = self._states.pop(device, None)
+        except TypeError:
+            entry = self._fallback.pop(device, None)
+
+        if entry is not None:
+            self._remove_listener(device, entry[1])
+
+    def __len__(self):
+        return len(self._states) + len(self._fallback)
+
+    def _remove_listener(self, device, listener):
+        try:
+            if device.parameters_has_listener(listener):
+                device.remove_parameters_listener(listener)
+        except RuntimeError:
+            # The device has already been deleted
+            pass
 
 
 class UbermapDevices:
@@ -13,12 +248,13 @@ class UbermapDevices:
     SECTION_PARAMETER_VALUE_TYPES = 'ParameterValueTypes'
     SECTION_CONFIG  = 'Config'
 
-    device_config_cache = {}
-
-    regex = re.compile(r"^\d+\_", re.IGNORECASE)
-
     def __init__(self):
         self.cfg = config.load('devices')
+        # Derived state per device, see get_device_state
+        self.device_states = UbermapDeviceStates()
+        self.dump_writer = UbermapDumpWriter()
+        self.host_parameter_maps = UbermapHostParameterMaps(config.get_path('Plugin Parameter Configs'),
+                                                            config.check_interval)
         log.info('UbermapDevices ready')
 
     def get_device_name(self, device):
@@ -37,21 +273,15 @@ class UbermapDevices:
             return
 
         file_path = self.get_device_filename(device) + "_unmapped.txt"
-        unmapped_parameters = sorted([i.original_name for i in device.parameters[1:]
-                                      if i.original_name not in used_parameters])
+        # Live objects can only be read on the main thread, sorting and writing is left to the dump writer
+        unmapped_parameters = [i.original_name for i in device.parameters[1:] if i.original_name not in used_parameters]
 
-        log.debug('dumping device: ' + self.get_device_name(device) + "; used parameters count: "
-                  + str(len(used_parameters)) + "; unmapped parameters count: " + str(len(unmapped_parameters)))
+        log.debug('dumping device: %s; used parameters count: %d; unmapped parameters count: %d',
+                  self.get_device_name(device), len(used_parameters), len(unmapped_parameters))
 
-        if len(unmapped_parameters) > 0:
-            with open(file_path, 'w+') as f:
-                for parameter in unmapped_parameters:
-                    f.write("%s\n" % parameter)
-        else:
-            if os.path.isfile(file_path):
-                os.remove(file_path)
+        self.dump_writer.write(file_path, unmapped_parameters)
 
-        log.info('dumped device: ' + self.get_device_name(device))
+        log.info('dumped device: %s', self.get_device_name(device))
 
     def get_device_config(self, device):
         local_device_name = self.get_device_name(device)
@@ -66,72 +296,233 @@ class UbermapDevices:
 
         return cfg if cfg.get('Config', 'Ignore') == 'False' else False
 
+    def get_device_map(self, device, bank_name = None):
+        if not bank_name:
+            bank_name = self.SECTION_BANKS
+
+        device_config = self.get_device_config(device)
+        if not device_config or device_config.get(bank_name) is None:
+            return None
+
+        return device_config.get_compiled(('DeviceMap', bank_name), lambda cfg: DeviceMap(cfg, bank_name))
+
+    def preload_device_maps(self, limit, device_names = None):
+        config.preload(limit, {('DeviceMap', self.SECTION_BANKS): self._compile_preloaded_device_map}, device_names)
+
+    def _compile_preloaded_device_map(self, device_config):
+        # Runs on the preloader thread - only compile maps get_device_map would actually use
+        if device_config.get(self.SECTION_CONFIG, {}).get('Ignore') != 'False' or self.SECTION_BANKS not in device_config:
+            return None
+
+        return DeviceMap(device_config, self.SECTION_BANKS)
+
     def get_custom_device_banks(self, device):
+        # Called several times for every bank refresh, so the result (and dumping the unmapped parameters) is
+        # only recomputed when the device's config or parameter list changes
+        if not device:
+            return False
+
         device_config = self.get_device_config(device)
-        if not device_config:
+        generation = device_config.get_generation() if device_config else None
+        state = self.get_device_state(device)
+        if 'banks' in state and state['banks_generation'] == generation:
+            return state['banks']
+
+        device_map = self.get_device_map(device)
+        if not device_map:
             self.dump_device(device)
+            banks = False
+        else:
+            used_parameters = device_map.used_parameters
+            host_slots = self.get_host_slots(device_config)
+            if host_slots or device_map.has_slot_keys:
+                # Parameters addressed by host slot are only known once they're resolved
+                used_parameters = used_parameters | frozenset(
+                    parameter.original_name for _, mappings in device_map.banks
+                    for parameter, _ in self._resolve_bank(device, mappings, host_slots) if parameter is not None)
+
+            log.debug(lambda: "used params: " + ", ".join(sorted(used_parameters)))
+            self.dump_device(device, used_parameters)
+            banks = list(device_map.bank_names)
+
+        state['banks'] = banks
+        state['banks_generation'] = generation
+        return banks
+
+    def get_device_state(self, device):
+        """Returns a dict for caching anything derived from device and its parameters. It's dropped as soon as the
+        device's parameter list changes."""
+        state = self.device_states.get(device)
+        if state is not None:
+            return state
+
+        state = {}
+        self.device_states.add(device, state)
+        return state
+
+    def get_parameter_index(self, device):
+        """Returns a dict mapping original_name to (parameter, position) for every parameter of device, where the
+        first parameter in order wins."""
+        state = self.get_device_state(device)
+        index = state.get('parameter_index')
+        if index is not None:
+            return index
+
+        index = {}
+        for position, parameter in enumerate(device.parameters):
+            index.setdefault(parameter.original_name, (parameter, position))
+
+        state['parameter_index'] = index
+        return index
+
+    def get_custom_device_params(self, device, bank_name = None):
+        device_map = self.get_device_map(device, bank_name)
+
+        if not device_map:
             return False
 
-        banks = device_config.get(self.SECTION_BANKS)
-        bank_keys = device_config.get(self.SECTION_BANKS).keys()
-        used_params = set([re.sub(self.regex, '', p) for bank in bank_keys if banks.get(bank) is not None for p in banks.get(bank)])
-        log.debug("used params: " + ", ".join(sorted(used_params)))
-        self.dump_device(device, used_params)
-        return bank_keys
+        return [list(self.get_custom_device_bank_params(device, bank_index, bank_name))
+                for bank_index in range(len(device_map.banks))]
 
-    def get_custom_device_params(self, device, bank_name = None):
+    def get_custom_device_bank_params(self, device, bank_index, bank_name = None):
+        """Returns the parameters of a single bank of device, or False if the device isn't mapped or has no such
+        bank. Parameters are only looked up again when the device's config or parameter list changes, until then
+        the same list is returned, so it mustn't be modified but can be used as a cache key."""
         if not bank_name:
             bank_name = self.SECTION_BANKS
 
         device_config = self.get_device_config(device)
-
         if not device_config:
             return False
 
-        def parse_custom_parameter_values(values):
-            # Split the values on || to see if we have custom value start points specified
-            values_split = map(lambda s: s.split('||'), values)
-            has_value_start_points = all(len(x) == 2 for x in values_split)
-            if not has_value_start_points:
-                return [values, None]
-
-            return [[x[0] for x in values_split], [float(x[1]) for x in values_split]]
-
-        def get_custom_parameter_values(parameter_name):
-            values = device_config.get(self.SECTION_PARAMETER_VALUES, parameter_name)
-            if not values:
-                return [None, None]
-
-            # If we have an array, i.e. comma separated list, just use that
-            if isinstance(values, list):
-                return parse_custom_parameter_values(values)
-
-            # Otherwise try and look up the string key in ParameterValueTypes and use that
-            values_type = device_config.get(self.SECTION_PARAMETER_VALUE_TYPES, values)
-            if values_type:
-                return parse_custom_parameter_values(values_type)
-
-        def get_parameter_by_name(device, nameMapping):
-            count = 0
-            for i in device.parameters:
-                original_name = nameMapping[0]
-                if (original_name == i.original_name) or (original_name == str(count) + "_" + i.original_name) or re.match("^\d+\_\w+$" + i.original_name, original_name) :
-                    if not nameMapping[1]:
-                        custom_name = original_name
-                    elif nameMapping[1] == "*":
-                        custom_name = " ".join(re.sub('([A-Z][a-z]+)', r' \1', re.sub('([A-Z]+)', r' \1', original_name)).split())
-                    else:
-                        custom_name = nameMapping[1]
-                    log.info("got " + custom_name+ " for " + original_name)
-                    i.custom_name = custom_name
-
-                    [i.custom_parameter_values, i.custom_parameter_start_points] = get_custom_parameter_values(nameMapping[0])
-
-                    return i
-                count = count + 1
-
-        def names_to_params(bank):
-            return map(partial(get_parameter_by_name, device), bank.items())
-
-        ret = map(names_to_params, device_config.get(bank_name).values())
-        return ret
+        generation = device_config.get_generation()
+        bank_params = self.get_device_state(device).setdefault('bank_params', {})
+        cached = bank_params.get((bank_name, bank_index))
+        if cached is not None and cached[0] == generation:
+            resolved, parameters = cached[1], cached[2]
+        else:
+            device_map = self.get_device_map(device, bank_name)
+            if not device_map or not 0 <= bank_index < len(device_map.banks):
+                return False
+
+            resolved = self._resolve_bank(device, device_map.banks[bank_index][1], self.get_host_slots(device_config))
+            parameters = [parameter for parameter, _ in resolved]
+            bank_params[(bank_name, bank_index)] = (generation, resolved, parameters)
+
+        # The same parameter can be mapped in several banks under different names, so the custom attributes are set
+        # for the bank being shown every time
+        for parameter, mapping in resolved:
+            if parameter is not None:
+                parameter.custom_name = mapping.display_name
+                parameter.custom_parameter_values = mapping.values
+                parameter.custom_parameter_start_points = mapping.start_points
+                parameter.custom_parameter_value_to_index = mapping.value_to_index
+
+        return parameters
+
+    def get_host_slots(self, device_config):
+        """Returns {plugin parameter name: host slot} from the host parameter map named in device_config, if any.
+        Only called when banks are resolved again, so changes to a map are picked up along with the next change to
+        the device's config or parameter list."""
+        name = device_config.get(self.SECTION_CONFIG, 'HostParameterMap')
+        if not name:
+            return None
+
+        host_parameter_map = self.host_parameter_maps.get(name)
+        if host_parameter_map is None:
+            log.info('host parameter map not found: %s', name)
+            return None
+        return host_parameter_map[1]
+
+    def _resolve_bank(self, device, mappings, host_slots = None):
+        parameter_index = self.get_parameter_index(device)
+        parameters = device.parameters
+
+        def get_parameter_by_name(mapping):
+            # Host parameter slots are positions in device.parameters, whose first parameter is "Device On"
+            if mapping.name is None:
+                position = mapping.position
+            else:
+                position = host_slots.get(mapping.key) if host_slots else None
+            if position is not None:
+                if position >= len(parameters):
+                    return None
+                log.info("got %s for %s in slot %d", mapping.display_name, mapping.key, position)
+                return parameters[position]
+
+            # A key is looked up as a name first, as parameters can have names like "1_Cutoff" themselves. If it's
+            # also a valid "N_name" address, the parameter that comes first wins.
+            found = parameter_index.get(mapping.key)
+            position = mapping.position
+            if position is not None and position < len(parameters) and (found is None or position < found[1]) and \
+                    parameters[position].original_name == mapping.name:
+                found = (parameters[position], position)
+
+            if found is None:
+                return None
+
+            log.info("got %s for %s", mapping.display_name, mapping.key)
+            return found[0]
+
+        return tuple((get_parameter_by_name(mapping), mapping) for mapping in mappings)
+
+
+class UbermapSetPrefetcher:
+    """Warms the config and DeviceMap caches for the devices used in the current Live set, including devices
+    nested in rack chains, whenever the set's tracks or devices change."""
+
+    def __init__(self, ubermap):
+        self.ubermap = ubermap
+        self.song = None
+
+    def start(self, song):
+        self.song = song
+        for add_listener, has_listener in ((song.add_tracks_listener, song.tracks_has_listener),
+                                           (song.add_return_tracks_listener, song.return_tracks_has_listener)):
+            if not has_listener(self.prefetch):
+                add_listener(self.prefetch)
+
+        self.prefetch()
+
+    def stop(self):
+        if self.song is None:
+            return
+
+        try:
+            for remove_listener, has_listener in ((self.song.remove_tracks_listener, self.song.tracks_has_listener),
+                                                  (self.song.remove_return_tracks_listener,
+                                                   self.song.return_tracks_has_listener)):
+                if has_listener(self.prefetch):
+                    remove_listener(self.prefetch)
+        except RuntimeError:
+            # The song has already been deleted, e.g. because another set was loaded
+            pass
+        self.song = None
+
+    def prefetch(self):
+        if self.song is None:
+            return
+
+        device_names = set()
+        for track in list(self.song.tracks) + list(self.song.return_tracks) + [self.song.master_track]:
+            self._collect_device_names(track, device_names)
+
+        log.debug('prefetching configs for %d devices in the current set', len(device_names))
+        self.ubermap.preload_device_maps(len(device_names), device_names)
+
+    def _collect_device_names(self, container, device_names):
+        # container is a track or a rack chain
+        if not container.devices_has_listener(self.prefetch):
+            container.add_devices_listener(self.prefetch)
+
+        for device in container.devices:
+            device_names.add(self.ubermap.get_device_name(device))
+            if getattr(device, 'can_have_chains', False):
+                # Adding or removing a chain doesn't change any devices list, so listen to the rack's chains too
+                for name in ('chains', 'return_chains'):
+                    has_listener = getattr(device, name + '_has_listener', None)
+                    if has_listener is not None and not has_listener(self.prefetch):
+                        getattr(device, 'add_' + name + '_listener')(self.prefetch)
+
+                for chain in list(device.chains) + list(getattr(device, 'return_chains', [])):
+                    self._collect_device_names(chain, device_names)
@@ -5,6 +5,8 @@
 # Ubermap
 from Ubermap import UbermapDevices
 from Ubermap.UbermapLibs import log, config
+from Ubermap.UbermapTracer import UbermapTracer
+from Ubermap.UbermapPerf import UbermapPerf
 # BankingUtil
 from ableton.v2.control_surface import banking_util
 # DeviceParameterBank
@@ -15,33 +17,77 @@ from ableton.v2.control_surface.parameter_provider import ParameterInfo
 # DeviceParameterAdapter
 from ableton.v2.base import listenable_property
 from Push2.model.repr import DeviceParameterAdapter
-from math import floor
-import inspect
 
 
 def apply_ubermap_patches(is_v1):
     log.info("Applying UbermapDevices patches")
 
-    apply_log_method_patches()
+    apply_tracer()
     apply_banking_util_patches()
     apply_device_component_patches(is_v1)
     apply_device_parameter_bank_patches()
     apply_device_parameter_adapater_patches()
 
+    if ubermap_config.get('Cache', 'Preload') == 'True':
+        ubermap.preload_device_maps(get_preload_limit())
+
+    if ubermap_config.get('Cache', 'PrefetchSet') != 'False':
+        apply_set_prefetch()
+
 
 # Create singleton UbermapDevices instance
 ubermap = UbermapDevices.UbermapDevices()
 ubermap_config = config.load('global')
+set_prefetcher = UbermapDevices.UbermapSetPrefetcher(ubermap)
+# Created on import, i.e. on Live's main thread, which is the thread it samples
+tracer = UbermapTracer(ubermap_config, config.get_path('trace.folded'))
+
+
+def get_preload_limit():
+    limit = ubermap_config.get('Cache', 'PreloadLimit')
+    try:
+        return int(limit or 100)
+    except ValueError:
+        log.error('invalid Cache PreloadLimit: %s', limit)
+        return 100
+
+
+def get_perf_interval():
+    interval = ubermap_config.get('Perf', 'Interval')
+    try:
+        seconds = float(interval or 60)
+    except ValueError:
+        seconds = None
+
+    # Also rules out nan and inf, with which no report would ever be written
+    if seconds is None or not 0 < seconds < float('inf'):
+        log.error('invalid Perf Interval: %s', interval)
+        return 60.0
+    return seconds
+
+
+perf = UbermapPerf(ubermap_config.get('Perf', 'Enabled') == 'True', get_perf_interval())
+
+
+# Device names for perf stats, from the arguments of the patched functions
+def device_argument_name(args):
+    return ubermap.get_device_name(args[0])
 
 
-def apply_log_method_patches():
-    # Log any method calls made to the object - useful for tracing execution flow
-    # Use like: DeviceComponent.__getattribute__ = __getattribute__
-    def __getattribute__(self, name):
-        returned = object.__getattribute__(self, name)
-        if inspect.isfunction(returned) or inspect.ismethod(returned):
-            log.info('Called ' + self.__class__.__name__ + '::' + str(returned.__name__))
-        return returned
+def parameter_adapter_device_name(args):
+    return ubermap.get_device_name(args[0]._adaptee.canonical_parent)
+
+
+def apply_set_prefetch():
+    # Called again whenever Live creates a new script instance, e.g. when another set is loaded
+    import Live
+    set_prefetcher.stop()
+    set_prefetcher.start(Live.Application.get_application().get_document())
+
+
+def apply_tracer():
+    # Sampling profiler for tracing execution flow, switched on and off with [Trace] Enabled in global.cfg
+    tracer.start()
 
 ############################################################################################################
 
@@ -58,7 +104,8 @@ def apply_banking_util_patches():
 
         return device_bank_names_orig(device, bank_size, definitions)
 
-    banking_util.device_bank_names = device_bank_names
+    banking_util.device_bank_names = perf.timed('banking_util.device_bank_names', device_bank_names,
+                                                device_argument_name)
 
     # device_bank_count - return Ubermap bank count if defined, otherwise use the default
     device_bank_count_orig = banking_util.device_bank_count
@@ -70,7 +117,8 @@ def apply_banking_util_patches():
 
         return device_bank_count_orig(device, bank_size, definition, definitions)
 
-    banking_util.device_bank_count = device_bank_count
+    banking_util.device_bank_count = perf.timed('banking_util.device_bank_count', device_bank_count,
+                                                device_argument_name)
 
 ############################################################################################################
 
@@ -91,7 +139,9 @@ def apply_device_parameter_bank_patches():
         orig = _collect_parameters_orig(self)
         return orig
 
-    DeviceParameterBank._collect_parameters = _collect_parameters
+    DeviceParameterBank._collect_parameters = perf.timed('DeviceParameterBank._collect_parameters',
+                                                         _collect_parameters,
+                                                         lambda args: ubermap.get_device_name(args[0]._device))
 
 ############################################################################################################
 
@@ -113,17 +163,25 @@ def apply_device_component_patches(is_v1):
                              fine_grain_encoder_sensitivity=fine_grain_parameter_mapping_sensitivity(parameter))
 
     def _get_provided_parameters(self):
-        ubermap_params = ubermap.get_custom_device_params(self._decorated_device)
-        if ubermap_params:
-            ubermap_params_list = list(ubermap_params)
-            param_bank = ubermap_params_list[self._bank.index]
+        param_bank = ubermap.get_custom_device_bank_params(self._decorated_device, self._bank.index)
+        if param_bank:
+            # ParameterInfos are reused for as long as the bank's parameters are, i.e. until the device's config
+            # or parameter list changes
+            param_info_cache = ubermap.get_device_state(self._decorated_device).setdefault(('param_info', is_v1), {})
+            cached = param_info_cache.get(self._bank.index)
+            if cached is not None and cached[0] is param_bank:
+                return list(cached[1])
+
             param_info = list(map(lambda parameter: _get_parameter_info(self, parameter), param_bank))
-            return param_info
+            param_info_cache[self._bank.index] = (param_bank, param_info)
+            return list(param_info)
 
         orig_params = _get_provided_parameters_orig(self)
         return orig_params
 
-    DeviceComponent._get_provided_parameters = _get_provided_parameters
+    DeviceComponent._get_provided_parameters = perf.timed(
+        'DeviceComponent._get_provided_parameters', _get_provided_parameters,
+        lambda args: ubermap.get_device_name(args[0]._decorated_device))
 
 ############################################################################################################
 
@@ -135,7 +193,8 @@ def apply_device_parameter_adapater_patches():
         else:
             return self._adaptee.name
 
-    DeviceParameterAdapter.name = listenable_property(name)
+    DeviceParameterAdapter.name = listenable_property(perf.timed('DeviceParameterAdapter.name', name,
+                                                                 parameter_adapter_device_name))
 
     def valueItems(self):
         if getattr(self._adaptee, 'custom_parameter_values', None):
@@ -145,34 +204,16 @@ def apply_device_parameter_adapater_patches():
                 return self._adaptee.value_items
             return []
 
-    DeviceParameterAdapter.valueItems = listenable_property(valueItems)
-
-    def value_to_start_point_index(value, start_points):
-        log.debug("start_points: " + str(start_points) + ", len: " + str(len(start_points)) + ", value: " + str(value))
-        for index, start_point in enumerate(start_points):
-            log.debug("index: " + str(index) + ", start_point: " + str(start_point) + ", value: " + str(value))
-            if value > start_point and (index == len(start_points) - 1 or value < start_points[index + 1]):
-                log.debug("Input value: " + str(value) + ", output index: " + str(index) + " with custom start points")
-                return index
-
-    def value_to_index(value, parameter_values):
-        values_len = len(parameter_values)
-        value_index = floor(value * values_len)
-
-        # If the value is 1.00 we don't want an off by one error
-        value_index = value_index - 1 if value_index == values_len else value_index
-
-        log.debug("Input value: " + str(value) + ", output index: " + str(value_index))
-
-        return value_index
+    DeviceParameterAdapter.valueItems = listenable_property(perf.timed('DeviceParameterAdapter.valueItems', valueItems,
+                                                                       parameter_adapter_device_name))
 
     def value(self):
-        if getattr(self._adaptee, 'custom_parameter_values', None):
-            if getattr(self._adaptee, 'custom_parameter_start_points', None):
-                return value_to_start_point_index(self._adaptee.value, self._adaptee.custom_parameter_start_points)
-            else:
-               return value_to_index(self._adaptee.value, self._adaptee.custom_parameter_values)
+        # Custom values are compiled with the device's config, see DeviceMap
+        value_to_index = getattr(self._adaptee, 'custom_parameter_value_to_index', None)
+        if value_to_index is not None:
+            return value_to_index(self._adaptee.value)
         else:
             return self._adaptee.value
 
-    DeviceParameterAdapter.value = listenable_property(value)
+    DeviceParameterAdapter.value = listenable_property(perf.timed('DeviceParameterAdapter.value', value,
+                                                                  parameter_adapter_device_name))